@@ -29,19 +29,37 @@ from __future__ import annotations
 
 import argparse
 import asyncio
-import hashlib
 import json
 import logging
+import os
+import queue
+import re
+import sqlite3
+import stat
+import sys
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Set
+from typing import Dict, List, Optional, Set, Tuple
 
-from qdrant_client import QdrantClient
+import torch
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models as rest
 from sentence_transformers import SentenceTransformer
 from watchdog.events import FileSystemEvent, FileSystemEventHandler
 from watchdog.observers import Observer
 
+from qdrant_common import (
+    IGNORED_DIRS,
+    compute_file_hash,
+    fragment_payload,
+    iter_fragments,
+    load_embedding_model,
+)
+
 # 日志配置
 logging.basicConfig(
     level=logging.INFO,
@@ -54,6 +72,48 @@ SUPPORTED_EXTENSIONS = {
     ".py", ".rs", ".go", ".js", ".jsx", ".ts", ".tsx", ".java", ".kt", ".swift",
     ".c", ".cc", ".cpp", ".h", ".hpp", ".xml", ".json"
 }
+# str.endswith 直接比较后缀，无需构造 Path
+SUPPORTED_SUFFIX_TUPLE = tuple(SUPPORTED_EXTENSIONS)
+
+# 预编译的忽略规则：任一路径分量以 "." 开头（.git、.venv 等），或是 IGNORED_DIRS 中的目录
+# 对仓库目录之后的部分匹配（search 的 pos 指向仓库路径末尾的分隔符）
+_SEP = re.escape(os.sep)
+_IGNORED_PATH_RE = re.compile(
+    rf"{_SEP}(?:\.|(?:{'|'.join(re.escape(d) for d in sorted(IGNORED_DIRS))}){_SEP})"
+)
+
+# Linux (inotify) 下每次保存只触发一次 closed 事件，可代替多次 modified 事件
+USE_CLOSE_EVENTS = sys.platform.startswith("linux") and hasattr(FileSystemEventHandler, "on_closed")
+
+# 单次 encode 的批大小（CPU 上更大的批次并不会更快）
+ENCODE_BATCH_SIZE = 64
+# 单次 upsert 的最大点数
+UPSERT_BATCH_SIZE = 256
+# 同时进行中的 upsert 请求数
+MAX_CONCURRENT_UPSERTS = 2
+
+# 文件指纹: (mtime, size, 内容哈希)
+FileSignature = Tuple[float, int, str]
+# 片段指纹: (文本哈希, start_byte, end_byte)
+FragmentSignature = Tuple[str, Optional[int], Optional[int]]
+
+
+@dataclass
+class FragmentBatch:
+    """单个文件的代码片段，按列存储，可直接用于 encode 与 upsert"""
+    abs_path: str
+    rel_path: str
+    language: str
+    ids: List[str] = field(default_factory=list)
+    texts: List[str] = field(default_factory=list)
+    text_hashes: List[str] = field(default_factory=list)
+    start_lines: List[int] = field(default_factory=list)
+    end_lines: List[int] = field(default_factory=list)
+    start_bytes: List[Optional[int]] = field(default_factory=list)
+    end_bytes: List[Optional[int]] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.ids)
 
 
 class QdrantAutoUpdater(FileSystemEventHandler):
@@ -66,221 +126,589 @@ class QdrantAutoUpdater(FileSystemEventHandler):
         collection: str,
         model_name: str,
         debounce_seconds: float = 2.0,
+        backend: str = "torch",
+        model_file: Optional[str] = None,
     ):
         self.repo_path = repo_path.resolve()
         self.qdrant_path = qdrant_path.resolve()
         self.collection = collection
         self.model_name = model_name
+        self.backend = backend
+        self.model_file = model_file
         self.debounce_seconds = debounce_seconds
 
-        # Qdrant 客户端
-        self.client = QdrantClient(path=str(qdrant_path))
+        # 事件过滤用的字符串前缀/后缀，回调中无需构造 Path
+        self.repo_path_str = str(self.repo_path)
+        repo_prefix = self.repo_path_str + os.sep
+        self._repo_prefix_len = len(repo_prefix)
+
+        # Qdrant 客户端（异步，upsert 可并发提交）
+        self.client = AsyncQdrantClient(path=str(qdrant_path))
+
+        # 嵌入模型：后台线程加载，加载期间文件事件照常入队
+        self.model: Optional[SentenceTransformer] = None
+        self._model_ready = threading.Event()
+        self._model_error: Optional[BaseException] = None
+        self._num_threads = os.cpu_count() or 1
+
+        # 哈希缓存（SQLite WAL，每次只写入变化的行）
+        # - file_hashes: abs_path -> (mtime, size, 内容哈希)
+        # - fragment_hashes: abs_path -> {frag_id: (文本哈希, start_byte, end_byte)}，
+        #   文本未变的片段不再重新编码，只在字节偏移移动时更新 payload
+        self.hash_cache_file = qdrant_path / f"{collection}_watcher_cache.sqlite3"
+        self.file_hashes: Dict[str, FileSignature] = {}
+        self.fragment_hashes: Dict[str, Dict[str, FragmentSignature]] = {}
+        self._dirty_paths: Set[str] = set()
+        self.cache_db = self._open_hash_cache()
+        self._load_hash_cache()
 
-        # 嵌入模型
-        logger.info(f"📦 加载嵌入模型: {model_name}")
-        self.model = SentenceTransformer(model_name)
-        logger.info("✓ 模型加载完成")
+        # 防抖机制：记录待处理的文件
+        # watchdog 线程只向 events 投递 (路径, 时间)，主循环合并到 pending_files
+        self.events: queue.SimpleQueue = queue.SimpleQueue()
+        self.pending_files: Dict[str, float] = {}
 
-        # 文件哈希缓存
-        self.hash_cache_file = qdrant_path / f"{collection}_watcher_hashes.json"
-        self.file_hashes: Dict[str, str] = self._load_hash_cache()
+        # 文件读取/哈希/切片与 encode 在线程池中执行，不阻塞事件循环
+        self.pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
 
-        # 防抖机制：记录待处理的文件
-        self.pending_files: Set[Path] = set()
-        self.last_trigger_time: float = 0
+        threading.Thread(target=self._load_model_background, name="model-loader", daemon=True).start()
 
-        # 检查集合
-        self._check_collection()
+    def _load_model_background(self) -> None:
+        """后台加载模型，完成（或失败）后置位 _model_ready"""
+        logger.info(f"📦 加载嵌入模型: {self.model_name} (backend={self.backend})")
+        try:
+            self.model = load_embedding_model(
+                self.model_name, self.backend, self.model_file, num_threads=self._num_threads
+            )
+            logger.info("✓ 模型加载完成")
+        except Exception as e:
+            logger.error(f"❌ 嵌入模型加载失败: {e}")
+            self._model_error = e
+        finally:
+            self._model_ready.set()
+
+    def _encode_texts(self, texts: List[str]):
+        """批量生成归一化向量（关闭 autograd 记录）"""
+        # OpenMP 线程数按调用线程生效，线程池中的线程需要各自设置
+        if torch.get_num_threads() != self._num_threads:
+            torch.set_num_threads(self._num_threads)
+        with torch.inference_mode():
+            return self.model.encode(
+                texts,
+                batch_size=ENCODE_BATCH_SIZE,
+                show_progress_bar=False,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+            )
 
-    def _check_collection(self) -> None:
+    async def _check_collection(self) -> None:
         """检查 Qdrant 集合是否存在"""
-        collections = {c.name for c in self.client.get_collections().collections}
+        collections = {c.name for c in (await self.client.get_collections()).collections}
         if self.collection not in collections:
             raise RuntimeError(
                 f"Collection '{self.collection}' not found. Run qdrant_codebase_indexer.py first."
             )
         logger.info(f"✓ 集合已找到: {self.collection}")
-
-    def _load_hash_cache(self) -> Dict[str, str]:
-        """加载文件哈希缓存"""
-        if self.hash_cache_file.exists():
-            try:
-                with open(self.hash_cache_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.warning(f"无法加载哈希缓存: {e}")
-        return {}
+        # 不创建 abs_path 的 payload 索引：监控器总是打开本地存储，本地 Qdrant 不支持 payload 索引
+        # （payload_schema 始终为空，每次启动都会重复调用并产生 UserWarning），按路径删除时直接扫描过滤
+
+    def _open_hash_cache(self) -> sqlite3.Connection:
+        """打开（必要时创建）哈希缓存数据库"""
+        conn = sqlite3.connect(str(self.hash_cache_file))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes ("
+            "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS fragment_hashes ("
+            "id TEXT PRIMARY KEY, path TEXT, text_hash TEXT, start_byte INTEGER, end_byte INTEGER)"
+        )
+        # 旧版缓存没有字节偏移列（读出为 NULL，首次变化时补写 payload 中的偏移）
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(fragment_hashes)")}
+        for column in ("start_byte", "end_byte"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE fragment_hashes ADD COLUMN {column} INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS fragment_hashes_path ON fragment_hashes (path)")
+        conn.commit()
+        return conn
+
+    def _load_hash_cache(self) -> None:
+        """启动时一次性把哈希缓存读入内存"""
+        try:
+            for path, mtime, size, file_hash in self.cache_db.execute(
+                "SELECT path, mtime, size, hash FROM file_hashes"
+            ):
+                self.file_hashes[path] = (mtime, size, file_hash)
+            for frag_id, path, text_hash, start_byte, end_byte in self.cache_db.execute(
+                "SELECT id, path, text_hash, start_byte, end_byte FROM fragment_hashes"
+            ):
+                self.fragment_hashes.setdefault(path, {})[frag_id] = (text_hash, start_byte, end_byte)
+        except sqlite3.Error as e:
+            logger.warning(f"无法加载哈希缓存: {e}")
+
+        if not self.file_hashes:
+            self._import_legacy_hash_cache()
+
+    def _import_legacy_hash_cache(self) -> None:
+        """导入旧版 JSON 哈希缓存（只在数据库为空时执行一次）"""
+        legacy_file = self.qdrant_path / f"{self.collection}_watcher_hashes.json"
+        if not legacy_file.exists():
+            return
+        try:
+            with open(legacy_file, 'r') as f:
+                raw = json.load(f)
+        except Exception as e:
+            logger.warning(f"无法加载旧版哈希缓存: {e}")
+            return
+        # 旧版缓存只有哈希值：mtime/size 置为未知，首次变化时按哈希比对
+        for path, value in raw.items():
+            self.file_hashes[path] = (-1.0, -1, value) if isinstance(value, str) else tuple(value)
+        self._dirty_paths.update(self.file_hashes)
+        self._save_hash_cache()
+        logger.info(f"✓ 已导入旧版哈希缓存: {len(raw)} 个文件")
 
     def _save_hash_cache(self) -> None:
-        """保存文件哈希缓存"""
+        """只写入本轮有变化的文件及其片段哈希"""
+        if not self._dirty_paths:
+            return
         try:
-            with open(self.hash_cache_file, 'w') as f:
-                json.dump(self.file_hashes, f, indent=2)
-        except Exception as e:
+            with self.cache_db:
+                for path in self._dirty_paths:
+                    signature = self.file_hashes.get(path)
+                    if signature is None:
+                        continue
+                    self.cache_db.execute(
+                        "INSERT OR REPLACE INTO file_hashes (path, mtime, size, hash) VALUES (?, ?, ?, ?)",
+                        (path, *signature),
+                    )
+                    fragments = self.fragment_hashes.get(path)
+                    if fragments is None:
+                        continue
+                    self.cache_db.execute("DELETE FROM fragment_hashes WHERE path = ?", (path,))
+                    self.cache_db.executemany(
+                        "INSERT OR REPLACE INTO fragment_hashes (id, path, text_hash, start_byte, end_byte) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [(frag_id, path, *frag_signature) for frag_id, frag_signature in fragments.items()],
+                    )
+            self._dirty_paths.clear()
+        except sqlite3.Error as e:
             logger.error(f"保存哈希缓存失败: {e}")
 
-    def _compute_file_hash(self, file_path: Path) -> str:
-        """计算文件 MD5 哈希"""
-        hasher = hashlib.md5()
+    def _should_process_file(self, file_path: Path) -> Optional[FileSignature]:
+        """判断文件是否应该被处理，需要处理时返回新的文件指纹（扩展名与目录已在事件回调中过滤）"""
         try:
-            with open(file_path, 'rb') as f:
-                hasher.update(f.read())
-            return hasher.hexdigest()
-        except Exception:
-            return ""
-
-    def _should_process_file(self, file_path: Path) -> bool:
-        """判断文件是否应该被处理"""
-        if not file_path.exists() or not file_path.is_file():
-            return False
-
-        if file_path.suffix not in SUPPORTED_EXTENSIONS:
-            return False
+            st = file_path.stat()
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
 
-        # 跳过隐藏目录
-        if any(part.startswith(".") for part in file_path.parts):
-            return False
+        # mtime + size 未变化时直接跳过，不读取文件内容
+        file_str = str(file_path)
+        cached = self.file_hashes.get(file_str)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return None
 
         # 检查哈希
-        current_hash = self._compute_file_hash(file_path)
+        current_hash = compute_file_hash(file_path)
         if not current_hash:
-            return False
+            return None
 
-        file_str = str(file_path)
-        if file_str in self.file_hashes and self.file_hashes[file_str] == current_hash:
-            return False  # 文件未变化
+        signature = (st.st_mtime, st.st_size, current_hash)
+        if cached and cached[2] == current_hash:
+            # 内容未变化（如 touch），只刷新 mtime/size
+            self.file_hashes[file_str] = signature
+            self._dirty_paths.add(file_str)
+            return None
 
-        return True
+        return signature
 
-    def _extract_fragments(self, file_path: Path, window: int = 80, stride: int = 60):
+    def _extract_fragments(
+        self, file_path: Path, rel_path: str, window: int = 80, stride: int = 60
+    ) -> FragmentBatch:
         """提取代码片段（滑动窗口）"""
+        batch = FragmentBatch(
+            abs_path=str(file_path),
+            rel_path=rel_path,
+            language=file_path.suffix.lstrip("."),
+        )
         try:
-            text = file_path.read_text(encoding="utf-8")
-        except UnicodeDecodeError:
-            return []
-
-        lines = text.splitlines()
-        total_lines = len(lines)
-        fragments = []
-        idx = 0
-
-        while idx < total_lines:
-            segment = lines[idx : idx + window]
-            if segment:
-                snippet = "\n".join(segment)
-                start = idx + 1
-                end = min(idx + window, total_lines)
-
-                frag_id = hashlib.md5(f"{file_path}:{start}:{end}".encode("utf-8")).hexdigest()
-
-                fragments.append({
-                    "id": frag_id,
-                    "text": snippet,
-                    "abs_path": str(file_path),
-                    "rel_path": str(file_path.relative_to(self.repo_path)),
-                    "language": file_path.suffix.lstrip("."),
-                    "start_line": start,
-                    "end_line": end,
-                })
-            idx += stride
-
-        return fragments
-
-    def _index_file(self, file_path: Path) -> int:
-        """索引单个文件"""
-        try:
-            logger.info(f"📝 处理文件: {file_path.relative_to(self.repo_path)}")
-
-            # 提取片段
-            fragments = self._extract_fragments(file_path)
-            if not fragments:
-                logger.warning(f"   未提取到代码片段，跳过")
-                return 0
+            data = file_path.read_bytes()
+        except OSError:
+            return batch
 
-            # 生成向量
-            texts = [frag["text"] for frag in fragments]
-            embeddings = self.model.encode(
-                texts,
-                batch_size=64,
-                show_progress_bar=False,
-                normalize_embeddings=True
+        try:
+            fragments = iter_fragments(batch.abs_path, data, window, stride)
+        except UnicodeDecodeError:
+            return batch
+
+        for frag_id, start, end, start_byte, end_byte, snippet, text_hash in fragments:
+            batch.ids.append(frag_id)
+            batch.texts.append(snippet)
+            batch.text_hashes.append(text_hash)
+            batch.start_lines.append(start)
+            batch.end_lines.append(end)
+            batch.start_bytes.append(start_byte)
+            batch.end_bytes.append(end_byte)
+
+        return batch
+
+    def _changed_fragments(self, fragments: FragmentBatch) -> Tuple[List[int], List[int]]:
+        """与缓存比对，返回 (文本有变化需要重新编码的下标, 文本未变但字节偏移移动的下标)"""
+        cached = self.fragment_hashes.get(fragments.abs_path, {})
+        changed: List[int] = []
+        shifted: List[int] = []
+        for i, frag_id in enumerate(fragments.ids):
+            frag_signature = cached.get(frag_id)
+            if frag_signature is None or frag_signature[0] != fragments.text_hashes[i]:
+                changed.append(i)
+            elif frag_signature[1:] != (fragments.start_bytes[i], fragments.end_bytes[i]):
+                # 前面的行长度变化：文本与向量不变，但 payload 中的偏移已过期
+                shifted.append(i)
+        return changed, shifted
+
+    def _fragment_signatures(self, fragments: FragmentBatch) -> Dict[str, FragmentSignature]:
+        """当前片段写入缓存时的指纹"""
+        return {
+            frag_id: (text_hash, start_byte, end_byte)
+            for frag_id, text_hash, start_byte, end_byte in zip(
+                fragments.ids, fragments.text_hashes, fragments.start_bytes, fragments.end_bytes
             )
-
-            # 增量 upsert 到 Qdrant
-            self.client.upsert(
+        }
+
+    def _index_file(self, fragments: FragmentBatch, changed: List[int], embeddings):
+        """构建单个文件中变化片段的 Qdrant 点数据，返回 (ids, vectors, payloads)"""
+        ids = [fragments.ids[i] for i in changed]
+        vectors = embeddings.tolist()
+        payloads = [
+            fragment_payload(
+                fragments.rel_path,
+                fragments.abs_path,
+                fragments.language,
+                fragments.start_lines[i],
+                fragments.end_lines[i],
+                fragments.start_bytes[i],
+                fragments.end_bytes[i],
+                fragments.text_hashes[i],
+                fragments.texts[i],
+            )
+            for i in changed
+        ]
+
+        logger.info(f"   ✓ {fragments.rel_path}: {len(changed)}/{len(fragments)} 个代码片段有变化")
+        return ids, vectors, payloads
+
+    async def _upsert_points(self, ids, vectors, payloads) -> None:
+        """分片并发 upsert，任一分片失败则抛出异常"""
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPSERTS)
+
+        async def upsert_chunk(start: int) -> None:
+            async with semaphore:
+                await self.client.upsert(
+                    collection_name=self.collection,
+                    points=rest.Batch(
+                        ids=ids[start : start + UPSERT_BATCH_SIZE],
+                        vectors=vectors[start : start + UPSERT_BATCH_SIZE],
+                        payloads=payloads[start : start + UPSERT_BATCH_SIZE],
+                    ),
+                    wait=False,
+                )
+
+        results = await asyncio.gather(
+            *[upsert_chunk(i) for i in range(0, len(ids), UPSERT_BATCH_SIZE)],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def _prepare_file(self, file_path: Path, rel_path: str):
+        """检查并切分单个文件（在线程池中执行），无需处理时返回 None"""
+        signature = self._should_process_file(file_path)
+        if signature is None:
+            return None
+        logger.info(f"📝 处理文件: {rel_path}")
+        fragments = self._extract_fragments(file_path, rel_path)
+        if not fragments:
+            # 仍需处理：清理该文件之前的片段
+            logger.warning(f"   未提取到代码片段")
+        return (file_path, fragments, signature, *self._changed_fragments(fragments))
+
+    async def _delete_stale_points(self, file_fragments) -> None:
+        """删除文件变短后不再存在的旧片段（旧 id 不会被新的 upsert 覆盖）"""
+        stale_ids: List[str] = []
+        for _, fragments, _, _, _ in file_fragments:
+            cached = self.fragment_hashes.get(fragments.abs_path)
+            if cached is not None:
+                stale_ids.extend(set(cached) - set(fragments.ids))
+                continue
+            # 没有该文件的片段缓存：按路径删除不属于本次结果的点
+            await self.client.delete(
                 collection_name=self.collection,
-                points=rest.Batch(
-                    ids=[frag["id"] for frag in fragments],
-                    vectors=embeddings.tolist(),
-                    payloads=[{
-                        "path": frag["rel_path"],
-                        "abs_path": frag["abs_path"],
-                        "language": frag["language"],
-                        "start_line": frag["start_line"],
-                        "end_line": frag["end_line"],
-                    } for frag in fragments],
+                points_selector=rest.FilterSelector(
+                    filter=rest.Filter(
+                        must=[rest.FieldCondition(
+                            key="abs_path", match=rest.MatchValue(value=fragments.abs_path)
+                        )],
+                        must_not=[rest.HasIdCondition(has_id=fragments.ids)],
+                    )
                 ),
+                wait=False,
             )
 
-            # 更新哈希缓存
-            file_str = str(file_path)
-            self.file_hashes[file_str] = self._compute_file_hash(file_path)
+        if stale_ids:
+            await self.client.delete(
+                collection_name=self.collection,
+                points_selector=rest.PointIdsList(points=stale_ids),
+                wait=False,
+            )
 
-            logger.info(f"   ✅ 已更新 {len(fragments)} 个代码片段")
-            return len(fragments)
+    async def _update_shifted_offsets(self, file_fragments) -> None:
+        """只改写位置移动的片段的字节偏移（文本与向量不变，无需重新 upsert）"""
+        operations = [
+            rest.SetPayloadOperation(
+                set_payload=rest.SetPayload(
+                    payload={"start_byte": fragments.start_bytes[i], "end_byte": fragments.end_bytes[i]},
+                    points=[fragments.ids[i]],
+                )
+            )
+            for _, fragments, _, _, shifted in file_fragments
+            for i in shifted
+        ]
+        for start in range(0, len(operations), UPSERT_BATCH_SIZE):
+            await self.client.batch_update_points(
+                collection_name=self.collection,
+                update_operations=operations[start : start + UPSERT_BATCH_SIZE],
+                wait=False,
+            )
 
-        except Exception as e:
-            logger.error(f"   ❌ 索引失败: {e}")
-            return 0
+    def _file_signature(self, file_path: Path) -> Optional[FileSignature]:
+        """读取文件当前的 (mtime, size, 内容哈希)，不可读时返回 None"""
+        try:
+            st = file_path.stat()
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        file_hash = compute_file_hash(file_path)
+        if not file_hash:
+            return None
+        return st.st_mtime, st.st_size, file_hash
+
+    async def _warm_start_from_qdrant(self) -> None:
+        """本地缓存缺失时，从 Qdrant 已有的点重建缓存，避免首次变化时整库重新编码"""
+        logger.info("♻️  哈希缓存为空，从 Qdrant 重建...")
+        fragment_ids: Dict[str, Set[str]] = {}
+        offset = None
+        while True:
+            points, offset = await self.client.scroll(
+                collection_name=self.collection,
+                with_payload=["abs_path"],
+                with_vectors=False,
+                limit=10000,
+                offset=offset,
+            )
+            for point in points:
+                abs_path = (point.payload or {}).get("abs_path")
+                if not abs_path:
+                    continue
+                # Qdrant 返回带连字符的 UUID，统一成片段 id 使用的 32 位十六进制
+                point_id = uuid.UUID(point.id).hex if isinstance(point.id, str) else str(point.id)
+                fragment_ids.setdefault(abs_path, set()).add(point_id)
+            if offset is None:
+                break
+
+        # 假定索引与磁盘内容一致：为每个已索引文件计算一次指纹
+        loop = asyncio.get_running_loop()
+        paths = list(fragment_ids)
+        signatures = await asyncio.gather(*[
+            loop.run_in_executor(self.pool, self._file_signature, Path(path)) for path in paths
+        ])
+        # 监控已在运行：重建期间有事件的文件不记录指纹，按新文件处理，避免把未索引的修改当成已索引
+        self._drain_events()
+        for path, signature in zip(paths, signatures):
+            if signature is None:
+                continue
+            if path not in self.pending_files:
+                self.file_hashes[path] = signature
+            # 文本哈希未知：首次变化时重新编码，但旧片段 id 可用于清理
+            self.fragment_hashes[path] = dict.fromkeys(fragment_ids[path], ("", None, None))
+            self._dirty_paths.add(path)
+        self._save_hash_cache()
+        logger.info(f"✓ 已从 Qdrant 重建缓存: {len(self.file_hashes)} 个文件")
+
+    def _drain_events(self) -> None:
+        """取出事件队列中的全部路径，同一文件只保留最后一次事件时间"""
+        while True:
+            try:
+                src_path, event_time = self.events.get_nowait()
+            except queue.Empty:
+                break
+            self.pending_files[src_path] = event_time
 
-    def process_pending_files(self) -> None:
+    async def process_pending_files(self) -> None:
         """处理待处理的文件队列"""
+        # 模型加载失败时立即退出，不必等到有文件变化
+        if self._model_error is not None:
+            raise RuntimeError(f"嵌入模型加载失败: {self._model_error}") from self._model_error
+
+        self._drain_events()
         if not self.pending_files:
             return
 
+        # 模型仍在加载：事件保留在 pending_files 中，下一轮再处理
+        if not self._model_ready.is_set():
+            return
+
+        # 按文件独立防抖：只处理自身最后一次变化已超过防抖间隔的文件
         current_time = time.time()
-        if current_time - self.last_trigger_time < self.debounce_seconds:
-            # 还在防抖期间，稍后再处理
+        ready = [
+            src_path
+            for src_path, event_time in self.pending_files.items()
+            if current_time - event_time >= self.debounce_seconds
+        ]
+        if not ready:
+            return
+        for src_path in ready:
+            del self.pending_files[src_path]
+        # 事件路径都位于仓库目录下，相对路径直接按前缀长度切片
+        files_to_process = [
+            (Path(src_path), src_path[self._repo_prefix_len:]) for src_path in ready
+        ]
+
+        logger.info(f"🔄 处理 {len(files_to_process)} 个待更新文件...")
+
+        # 并行读取各文件，汇总文本有变化的片段，之后一次性生成向量
+        loop = asyncio.get_running_loop()
+        prepared = await asyncio.gather(*[
+            loop.run_in_executor(self.pool, self._prepare_file, file_path, rel_path)
+            for file_path, rel_path in files_to_process
+        ])
+        file_fragments = [item for item in prepared if item is not None]
+
+        if not file_fragments:
+            # 可能只刷新了 mtime/size
+            self._save_hash_cache()
             return
 
-        logger.info(f"🔄 处理 {len(self.pending_files)} 个待更新文件...")
+        # encode 内部会按文本长度排序分批，合并后整体 padding 更少
+        texts = [
+            fragments.texts[i]
+            for _, fragments, _, changed, _ in file_fragments
+            for i in changed
+        ]
+        all_ids, all_vectors, all_payloads = [], [], []
+        if texts:
+            try:
+                embeddings = await loop.run_in_executor(self.pool, self._encode_texts, texts)
+            except Exception as e:
+                logger.error(f"❌ 向量生成失败: {e}")
+                return
+
+            # 按文件切回各自的向量，再合并成一批点数据
+            offset = 0
+            for _, fragments, _, changed, _ in file_fragments:
+                ids, vectors, payloads = self._index_file(
+                    fragments, changed, embeddings[offset : offset + len(changed)]
+                )
+                offset += len(changed)
+                all_ids.extend(ids)
+                all_vectors.extend(vectors)
+                all_payloads.extend(payloads)
+
+            # 增量 upsert 到 Qdrant：整批提交，过大时分片并发
+            try:
+                await self._upsert_points(all_ids, all_vectors, all_payloads)
+            except Exception as e:
+                logger.error(f"❌ 索引失败: {e}")
+                return
 
-        total_fragments = 0
-        files_to_process = list(self.pending_files)
-        self.pending_files.clear()
+        try:
+            await self._delete_stale_points(file_fragments)
+        except Exception as e:
+            logger.warning(f"清理旧片段失败: {e}")
 
-        for file_path in files_to_process:
-            if self._should_process_file(file_path):
-                fragments_count = self._index_file(file_path)
-                total_fragments += fragments_count
+        offsets_updated = True
+        try:
+            await self._update_shifted_offsets(file_fragments)
+        except Exception as e:
+            logger.warning(f"更新片段偏移失败: {e}")
+            offsets_updated = False
+
+        # 更新哈希缓存
+        for file_path, fragments, signature, _, shifted in file_fragments:
+            self.file_hashes[str(file_path)] = signature
+            frag_signatures = self._fragment_signatures(fragments)
+            if not offsets_updated:
+                # 偏移未写入：记为未知，下次变化时重试
+                for i in shifted:
+                    frag_signatures[fragments.ids[i]] = (fragments.text_hashes[i], None, None)
+            self.fragment_hashes[fragments.abs_path] = frag_signatures
+            self._dirty_paths.add(str(file_path))
+        self._save_hash_cache()
+        logger.info(f"✅ 索引更新完成: {len(file_fragments)} 个文件, {len(all_ids)} 个片段重新编码")
 
-        if total_fragments > 0:
-            self._save_hash_cache()
-            logger.info(f"✅ 索引更新完成: {total_fragments} 个片段")
+    # ========== Watchdog 事件处理 ==========
 
-        self.last_trigger_time = current_time
+    # 回调运行在 watchdog 线程：只做字符串过滤并把原始路径入队，Path 构造留给主循环
 
-    # ========== Watchdog 事件处理 ==========
+    def _accept_event_path(self, src_path: str) -> bool:
+        """过滤忽略目录、隐藏目录和不支持的扩展名"""
+        if not src_path.endswith(SUPPORTED_SUFFIX_TUPLE):
+            return False
+        return _IGNORED_PATH_RE.search(src_path, self._repo_prefix_len - 1) is None
 
     def on_modified(self, event: FileSystemEvent) -> None:
-        """文件修改事件"""
-        if event.is_directory:
+        """文件修改事件（支持 closed 事件的平台上忽略）"""
+        if USE_CLOSE_EVENTS:
+            return
+        if event.is_directory or not self._accept_event_path(event.src_path):
             return
+        self.events.put_nowait((event.src_path, time.time()))
 
-        file_path = Path(event.src_path)
-        if file_path.suffix in SUPPORTED_EXTENSIONS:
-            logger.debug(f"🔔 检测到文件修改: {file_path.name}")
-            self.pending_files.add(file_path)
+    def on_closed(self, event: FileSystemEvent) -> None:
+        """写入后关闭事件（每次保存触发一次）"""
+        if event.is_directory or not self._accept_event_path(event.src_path):
+            return
+        self.events.put_nowait((event.src_path, time.time()))
 
     def on_created(self, event: FileSystemEvent) -> None:
         """文件创建事件"""
-        if event.is_directory:
+        if event.is_directory or not self._accept_event_path(event.src_path):
             return
+        self.events.put_nowait((event.src_path, time.time()))
+
+    def on_moved(self, event: FileSystemEvent) -> None:
+        """文件重命名事件（编辑器"写临时文件再改名"的保存方式）"""
+        if event.is_directory or not self._accept_event_path(event.dest_path):
+            return
+        self.events.put_nowait((event.dest_path, time.time()))
+
+    async def _watch_loop(self) -> None:
+        """检查集合后启动文件监控，并周期性处理待更新文件"""
+        await self._check_collection()
+
+        # 先启动监控：从 Qdrant 重建缓存期间的文件事件照常进入队列，重建完成后处理
+        observer = Observer()
+        observer.schedule(self, str(self.repo_path), recursive=True)
+        observer.start()
+
+        try:
+            if not self.file_hashes:
+                await self._warm_start_from_qdrant()
 
-        file_path = Path(event.src_path)
-        if file_path.suffix in SUPPORTED_EXTENSIONS:
-            logger.debug(f"🔔 检测到新文件: {file_path.name}")
-            self.pending_files.add(file_path)
+            logger.info("👀 文件监控已启动，等待代码变化...")
+            logger.info("按 Ctrl+C 停止")
+
+            while True:
+                await asyncio.sleep(1)
+                await self.process_pending_files()
+        finally:
+            observer.stop()
+            observer.join()
+            self.pool.shutdown(wait=True)
+            await self.client.close()
 
     def start_watching(self) -> None:
         """启动文件监控"""
@@ -289,26 +717,15 @@ class QdrantAutoUpdater(FileSystemEventHandler):
         logger.info("=" * 60)
         logger.info(f"📂 监控目录: {self.repo_path}")
         logger.info(f"🗄️  Qdrant 集合: {self.collection}")
-        logger.info(f"🧠 嵌入模型: {self.model_name}")
+        logger.info(f"🧠 嵌入模型: {self.model_name} (backend={self.backend})")
         logger.info(f"⏱️  防抖间隔: {self.debounce_seconds} 秒")
         logger.info("=" * 60)
 
-        observer = Observer()
-        observer.schedule(self, str(self.repo_path), recursive=True)
-        observer.start()
-
-        logger.info("👀 文件监控已启动，等待代码变化...")
-        logger.info("按 Ctrl+C 停止")
-
         try:
-            while True:
-                time.sleep(1)
-                self.process_pending_files()
+            asyncio.run(self._watch_loop())
         except KeyboardInterrupt:
             logger.info("\n🛑 收到停止信号...")
-            observer.stop()
 
-        observer.join()
         logger.info("✓ 监控已停止")
 
 
@@ -324,8 +741,14 @@ def build_parser() -> argparse.ArgumentParser:
   # 自定义防抖时间（5 秒）
   python qdrant_auto_updater.py --repo /path/to/repo --collection codebase --debounce 5
 
+  # 使用 ONNX Runtime + INT8 量化模型（AVX512-VNNI CPU）
+  python qdrant_auto_updater.py --repo /path/to/repo --collection codebase \
+    --backend onnx --model-file onnx/model_qint8_avx512_vnni.onnx
+
 依赖:
   pip install qdrant-client sentence-transformers watchdog
+  pip install blake3  # 可选，加速文件哈希
+  pip install "sentence-transformers[onnx]"  # 可选，--backend onnx
         """
     )
     parser.add_argument("--repo", required=True, help="Path to repository root")
@@ -333,6 +756,10 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument("--collection", default="codebase", help="Collection name")
     parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2", help="Embedding model")
     parser.add_argument("--debounce", type=float, default=2.0, help="Debounce interval in seconds")
+    parser.add_argument("--backend", choices=["torch", "onnx", "openvino"], default="torch",
+                        help="SentenceTransformer inference backend")
+    parser.add_argument("--model-file", default=None,
+                        help="Model file for onnx/openvino backend, e.g. onnx/model_qint8_avx512_vnni.onnx")
     return parser
 
 
@@ -350,6 +777,8 @@ def main() -> None:
         collection=args.collection,
         model_name=args.model,
         debounce_seconds=args.debounce,
+        backend=args.backend,
+        model_file=args.model_file,
     )
 
     updater.start_watching()
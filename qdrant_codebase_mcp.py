@@ -22,8 +22,7 @@
         --qdrant-path ./qdrant_storage \
         --collection felo_android \
         --port 8890 \
-        --auto-update \
-        --update-interval 30  # 30 分钟检查一次
+        --auto-update  # 文件变化后自动更新（--update-mode poll 为定时扫描）
 
 3. 在 ~/.claude/mcp.json 中注册服务端点 (http://localhost:8890/mcp)
 
@@ -36,20 +35,53 @@ from __future__ import annotations
 
 import argparse
 import asyncio
-import hashlib
 import json
 import logging
+import mmap
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+import numpy as np
+import torch
 from fastmcp import FastMCP
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models as rest
 from qdrant_client.http.models import Distance
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
+from qdrant_common import (
+    BULK_THRESHOLD,
+    IGNORED_DIRS,
+    PAYLOAD_TEXT_MAX_CHARS,
+    EmbeddingCache,
+    async_pause_indexing,
+    async_resume_indexing,
+    compute_file_hash,
+    hash_text,
+    iter_fragments,
+    load_embedding_model,
+    record_payload,
+)
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    from watchdog.events import FileSystemEvent, FileSystemEventHandler
+    from watchdog.observers import Observer
+    HAS_WATCHDOG = True
+except ImportError:
+    FileSystemEventHandler = object
+    HAS_WATCHDOG = False
+
 # 日志配置
 logging.basicConfig(
     level=logging.INFO,
@@ -63,6 +95,75 @@ SUPPORTED_EXTENSIONS = {
     ".c", ".cc", ".cpp", ".h", ".hpp", ".xml", ".json"
 }
 
+# 变化检测时并行计算文件哈希的线程数（以 I/O 为主，可多于 CPU 核数）
+HASH_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# 每批 encode + upsert 的片段数
+UPSERT_BATCH_SIZE = 256
+# 同时进行中的 upsert 请求数（encode 下一批时，前几批的 upsert 仍在进行）
+MAX_CONCURRENT_UPSERTS = 4
+# 比对变化文件时同时进行中的 scroll 请求数（每个文件读取一次已有的点）
+MAX_CONCURRENT_SCROLLS = 8
+# 并行提取片段的线程数（读文件与 NumPy 换行扫描可释放 GIL）
+EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+
+# 文件监控模式：最后一次文件事件后静默该秒数再触发更新
+WATCH_DEBOUNCE_SECONDS = 5.0
+# 事件持续不断时（构建输出、持续写入的文件），自第一个事件起最多等待该秒数即更新
+WATCH_MAX_DELAY_SECONDS = 30.0
+
+
+@lru_cache(maxsize=128)
+def _read_byte_range(path: str, mtime_ns: int, size: int, start: int, end: int) -> bytes:
+    """通过 mmap 只读取文件的指定字节区间；mtime/size 参与缓存键，文件变化后自动失效"""
+    if size == 0:
+        return b""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[start:end]
+
+
+class _RepoEventHandler(FileSystemEventHandler):
+    """把受支持源文件的变化路径投递到事件循环中的队列（回调运行在 watchdog 线程）"""
+
+    # 只处理内容可能变化的事件；只读打开产生的 opened / closed_no_write 会被
+    # 本服务自己的哈希与片段提取、search_code 读取片段以及 IDE、grep 等外部读取触发
+    CONTENT_EVENT_TYPES = frozenset({"created", "modified", "moved", "deleted", "closed"})
+
+    def __init__(
+        self, repo_path: Path, qdrant_path: Path, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue
+    ) -> None:
+        super().__init__()
+        self.repo_path = repo_path
+        # 存储目录位于仓库内时（如 --repo . 配合默认的 ./qdrant_storage），本服务写入的
+        # 哈希缓存 JSON 等文件不能再触发更新，否则每次更新都会引发下一次更新
+        self.storage_prefix = str(qdrant_path) + os.sep
+        self.loop = loop
+        self.queue = queue
+
+    def _push(self, path: str) -> None:
+        name = os.path.basename(path)
+        dot = name.rfind(".")
+        if dot <= 0 or name[dot:].lower() not in SUPPORTED_EXTENSIONS:
+            return
+        if path.startswith(self.storage_prefix):
+            return
+        try:
+            rel_parts = Path(path).relative_to(self.repo_path).parts
+        except ValueError:
+            return
+        # 跳过隐藏目录、隐藏文件与 IGNORED_DIRS（最后一个分量是文件名）
+        if any(part.startswith(".") for part in rel_parts) or not IGNORED_DIRS.isdisjoint(rel_parts[:-1]):
+            return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, path)
+
+    def on_any_event(self, event: FileSystemEvent) -> None:
+        if event.is_directory or event.event_type not in self.CONTENT_EVENT_TYPES:
+            return
+        self._push(event.src_path)
+        dest_path = getattr(event, "dest_path", "")
+        if dest_path:
+            self._push(dest_path)
+
 
 class QdrantCodebaseService:
     def __init__(
@@ -73,50 +174,119 @@ class QdrantCodebaseService:
         model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
         auto_update: bool = False,
         update_interval_minutes: int = 30,
+        update_mode: str = "watch",
+        backend: str = "torch",
+        model_file: str | None = None,
+        qdrant_url: str | None = None,
     ) -> None:
         self.repo_path = repo_path.resolve()
         self.qdrant_path = qdrant_path.resolve()
-        self.client = QdrantClient(path=str(self.qdrant_path))
+        self.qdrant_url = qdrant_url
+        if qdrant_url:
+            # 远程服务走 gRPC：向量以二进制 float 数组传输，无需 JSON 序列化
+            self.client = AsyncQdrantClient(url=qdrant_url, prefer_grpc=True)
+        else:
+            # 本地模式会锁定存储目录，同一进程只能持有一个客户端
+            self.client = AsyncQdrantClient(path=str(self.qdrant_path))
         self.collection = collection
         self.model_name = model_name
-        self.model = SentenceTransformer(model_name)
+        self.backend = backend
+        self.model_file = model_file
+        self._num_threads = os.cpu_count() or 1
+        self.model = load_embedding_model(model_name, backend, model_file, num_threads=self._num_threads)
+        # 查询向量缓存：交互式会话中重复的查询直接命中
+        self._encode_cached = lru_cache(maxsize=1024)(self._encode)
+        # 预热：首次推理的图优化/内存分配不计入第一次搜索
+        self._encode("warmup")
         self.mcp = FastMCP("qdrant-codebase")
 
         # 自动更新配置
         self.auto_update = auto_update
         self.update_interval = update_interval_minutes * 60  # 转换为秒
+        # watch: 文件系统事件驱动；poll: 定时全量扫描（NFS/容器等事件不可靠的环境）
+        if update_mode == "watch" and not HAS_WATCHDOG:
+            logger.warning("⚠️  未安装 watchdog，自动更新回退为定时扫描 (pip install watchdog)")
+            update_mode = "poll"
+        self.update_mode = update_mode
         self.last_check_time: datetime | None = None
         self.update_task: asyncio.Task | None = None
+        # 自动更新与手动触发共用，避免两次更新同时修改哈希缓存（在事件循环中创建）
+        self._update_lock: asyncio.Lock | None = None
+
+        # 本地缓存目录（--url 模式下没有本地 Qdrant 客户端替我们创建它）
+        self.qdrant_path.mkdir(parents=True, exist_ok=True)
 
         # 文件哈希缓存
         self.hash_cache_file = self.qdrant_path / f"{collection}_file_hashes.json"
-        self.file_hashes: Dict[str, str] = self._load_hash_cache()
+        # {abs_path: {"mtime": st_mtime_ns, "size": st_size, "hash": 内容哈希}}
+        self.file_hashes: Dict[str, Dict[str, Any]] = self._load_hash_cache()
+        self._hash_cache_dirty = False
+
+        # 片段向量缓存（与增量更新工具共用同一文件）
+        self.embedding_cache = EmbeddingCache(
+            self.qdrant_path / f"{collection}_embedding_cache.sqlite3", model_name
+        )
+
+        # 片段提取线程池（常驻，各次更新共用）
+        self._extract_pool = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="extract")
 
-        self._check_collection()
         self._register_tools()
 
-        if auto_update:
+        if auto_update and self.update_mode == "watch":
+            logger.info("🔄 自动更新已启用，文件监控模式")
+        elif auto_update:
             logger.info(f"🔄 自动更新已启用，间隔: {update_interval_minutes} 分钟")
 
     # ------------------------------------------------------------------
     # Helpers
     # ------------------------------------------------------------------
-    def _check_collection(self) -> None:
-        collections = {c.name for c in self.client.get_collections().collections}
+    async def _check_collection(self) -> None:
+        collections = {c.name for c in (await self.client.get_collections()).collections}
         if self.collection not in collections:
             raise RuntimeError(
                 f"Collection '{self.collection}' not found. Was the indexer run?"
             )
 
-        info = self.client.get_collection(self.collection)
+        info = await self.client.get_collection(self.collection)
         vectors = info.config.params.vectors
         if vectors is None or vectors.distance != Distance.COSINE:
             raise RuntimeError(
                 "Collection distance must be COSINE to match query embeddings."
             )
 
+        # 向量已归一化，FLOAT16 存储 + INT8 标量量化几乎不影响余弦排序，可显著降低服务端内存与磁盘占用
+        # （需在索引器创建集合时配置；本地模式会忽略这两项，因此只对 Qdrant 服务给出提示）
+        if self.qdrant_url:
+            if vectors.datatype != rest.Datatype.FLOAT16:
+                logger.info("💡 集合向量未使用 FLOAT16 存储，可在创建集合时设置 datatype=Datatype.FLOAT16")
+            if info.config.quantization_config is None and vectors.quantization_config is None:
+                logger.info("💡 集合未启用量化，可配置 ScalarQuantization(type=INT8, always_ram=True)")
+
+    def _encode_batch(self, texts: List[str]):
+        """批量生成归一化向量（关闭 autograd 记录）"""
+        # OpenMP 线程数按调用线程生效，线程池中的线程需要各自设置
+        if torch.get_num_threads() != self._num_threads:
+            torch.set_num_threads(self._num_threads)
+        with torch.inference_mode():
+            return self.model.encode(texts, batch_size=64, show_progress_bar=False, normalize_embeddings=True)
+
+    def _embed_fragments(self, fragments: List[Dict[str, Any]]) -> np.ndarray:
+        """生成片段向量：先查持久缓存，只对未命中的片段调用模型"""
+        hashes = [frag["content_hash"] for frag in fragments]
+        vectors = self.embedding_cache.get_many(hashes)
+        misses = [i for i, content_hash in enumerate(hashes) if content_hash not in vectors]
+        if misses:
+            encoded = self._encode_batch([fragments[i]["text"] for i in misses])
+            miss_hashes = [hashes[i] for i in misses]
+            self.embedding_cache.put_many(miss_hashes, encoded)
+            vectors.update(zip(miss_hashes, encoded))
+        return np.stack([vectors[content_hash] for content_hash in hashes])
+
     def _encode(self, text: str) -> List[float]:
-        vector = self.model.encode([text], normalize_embeddings=True)[0]
+        if torch.get_num_threads() != self._num_threads:
+            torch.set_num_threads(self._num_threads)
+        with torch.inference_mode():
+            vector = self.model.encode([text], normalize_embeddings=True)[0]
         return vector.tolist()
 
     def _resolve_path(self, payload_path: str | None, payload_abs: str | None) -> Path:
@@ -132,6 +302,25 @@ class QdrantCodebaseService:
 
     def _read_snippet(self, payload: Dict[str, Any]) -> str:
         file_path = self._resolve_path(payload.get("path"), payload.get("abs_path"))
+
+        # 有字节偏移时只读取片段对应的字节；内容哈希不一致（文件已修改）时回退到按行读取
+        start_byte, end_byte = payload.get("start_byte"), payload.get("end_byte")
+        if start_byte is not None and end_byte is not None:
+            try:
+                st = file_path.stat()
+                segment = _read_byte_range(str(file_path), st.st_mtime_ns, st.st_size, start_byte, end_byte)
+            except (OSError, ValueError):
+                segment = None
+            if segment is not None:
+                if b"\r" in segment:
+                    segment = segment.replace(b"\r\n", b"\n")
+                    if segment.endswith(b"\r"):
+                        segment = segment[:-1]
+                snippet = segment.decode("utf-8", errors="replace")
+                content_hash = payload.get("content_hash")
+                if content_hash is None or hash_text(snippet) == content_hash:
+                    return snippet
+
         try:
             lines = file_path.read_text(encoding="utf-8").splitlines()
         except FileNotFoundError:
@@ -142,162 +331,352 @@ class QdrantCodebaseService:
         snippet = "\n".join(lines[start:end])
         return snippet
 
+    def _can_backfill_text(self, payload: Dict[str, Any], snippet: str) -> bool:
+        """从文件读出的片段能否回填到 payload：有内容哈希时必须与索引时一致"""
+        if len(snippet) > PAYLOAD_TEXT_MAX_CHARS:
+            return False
+        content_hash = payload.get("content_hash")
+        if content_hash:
+            return hash_text(snippet) == content_hash
+        return snippet != "(file not found)"
+
+    async def _backfill_payload_text(self, snippets: List[Tuple[Any, str]]) -> None:
+        """为旧版本写入的点补写片段文本，下次命中时不再读文件"""
+        results = await asyncio.gather(
+            *(
+                self.client.set_payload(
+                    collection_name=self.collection,
+                    payload={"text": snippet},
+                    points=[point_id],
+                    wait=False,
+                )
+                for point_id, snippet in snippets
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.warning(f"回填片段文本失败: {result}")
+
     # ------------------------------------------------------------------
     # Auto-update helpers
     # ------------------------------------------------------------------
-    def _load_hash_cache(self) -> Dict[str, str]:
-        """加载文件哈希缓存"""
+    def _load_hash_cache(self) -> Dict[str, Dict[str, Any]]:
+        """加载文件哈希缓存（旧版 {path: hash} 格式的条目视为 stat 未知，下次扫描时重新校验哈希）"""
         if self.hash_cache_file.exists():
             try:
-                with open(self.hash_cache_file, 'r') as f:
-                    return json.load(f)
+                raw = self.hash_cache_file.read_bytes()
+                data = orjson.loads(raw) if HAS_ORJSON else json.loads(raw)
+                return {
+                    path: entry if isinstance(entry, dict) else {"mtime": None, "size": None, "hash": entry}
+                    for path, entry in data.items()
+                }
             except Exception as e:
                 logger.warning(f"无法加载哈希缓存: {e}")
         return {}
 
     def _save_hash_cache(self) -> None:
-        """保存文件哈希缓存"""
+        """保存文件哈希缓存（先写临时文件再原子替换，写入中断不会损坏已有缓存）"""
+        tmp_file = self.hash_cache_file.with_name(f"{self.hash_cache_file.name}.tmp.{os.getpid()}")
         try:
-            with open(self.hash_cache_file, 'w') as f:
-                json.dump(self.file_hashes, f, indent=2)
+            if HAS_ORJSON:
+                tmp_file.write_bytes(orjson.dumps(self.file_hashes))
+            else:
+                tmp_file.write_text(json.dumps(self.file_hashes, separators=(",", ":")), encoding="utf-8")
+            os.replace(tmp_file, self.hash_cache_file)
+            self._hash_cache_dirty = False
         except Exception as e:
             logger.error(f"保存哈希缓存失败: {e}")
-
-    def _compute_file_hash(self, file_path: Path) -> str:
-        """计算文件 MD5 哈希"""
-        hasher = hashlib.md5()
-        try:
-            with open(file_path, 'rb') as f:
-                hasher.update(f.read())
-            return hasher.hexdigest()
-        except Exception:
-            return ""
+            tmp_file.unlink(missing_ok=True)
 
     def _iter_source_files(self) -> List[Path]:
-        """遍历源代码文件"""
+        """遍历源代码文件（os.scandir 深度优先，隐藏目录、IGNORED_DIRS 与 Qdrant 存储目录在目录层级直接剪枝）"""
         files = []
-        for path in self.repo_path.rglob("*"):
-            if not path.is_file():
-                continue
-            if path.suffix.lower() not in SUPPORTED_EXTENSIONS:
-                continue
-            # 跳过隐藏目录
-            if any(part.startswith(".") for part in path.parts):
+        storage_dir = str(self.qdrant_path)
+        stack = [str(self.repo_path)]
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except OSError:
                 continue
-            files.append(path)
+            with it:
+                for entry in it:
+                    # 跳过隐藏目录与隐藏文件
+                    name = entry.name
+                    if name.startswith("."):
+                        continue
+                    try:
+                        # DirEntry 的类型信息来自 readdir，无需额外 stat
+                        if entry.is_dir(follow_symlinks=False):
+                            if name not in IGNORED_DIRS and entry.path != storage_dir:
+                                stack.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    dot = name.rfind(".")
+                    if dot > 0 and name[dot:].lower() in SUPPORTED_EXTENSIONS:
+                        files.append(Path(entry.path))
         return files
 
-    def _find_modified_files(self) -> List[Path]:
-        """查找修改过的文件"""
+    def _find_modified_files(self, files: Optional[List[Path]] = None) -> List[Path]:
+        """查找修改过的文件（mtime 与 size 均未变化的文件不再读取和计算哈希）；
+        files 为空时扫描整个仓库"""
         modified_files = []
-        all_files = self._iter_source_files()
+        candidates = []
 
-        for file_path in all_files:
+        for file_path in self._iter_source_files() if files is None else files:
+            try:
+                st = file_path.stat()
+            except OSError:
+                continue
+            cached = self.file_hashes.get(str(file_path))
+            if cached and cached["mtime"] == st.st_mtime_ns and cached["size"] == st.st_size:
+                continue
+            candidates.append((file_path, st))
+
+        # 哈希计算在线程池中并行（读文件与哈希计算均会释放 GIL）
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            hashes = list(executor.map(compute_file_hash, [path for path, _ in candidates]))
+
+        for (file_path, st), current_hash in zip(candidates, hashes):
             file_str = str(file_path)
-            current_hash = self._compute_file_hash(file_path)
 
             if not current_hash:
                 continue
 
-            # 检查是否有变化
-            if file_str not in self.file_hashes or self.file_hashes[file_str] != current_hash:
+            # stat 变化但内容未变（如 touch、checkout）时只刷新缓存的 stat
+            cached = self.file_hashes.get(file_str)
+            if cached is None or cached["hash"] != current_hash:
                 modified_files.append(file_path)
-                self.file_hashes[file_str] = current_hash
+            self.file_hashes[file_str] = {"mtime": st.st_mtime_ns, "size": st.st_size, "hash": current_hash}
+            self._hash_cache_dirty = True
 
         return modified_files
 
     def _extract_fragments(self, file_path: Path, window: int = 80, stride: int = 60) -> List[Dict[str, Any]]:
-        """从单个文件提取代码片段（滑动窗口方式）"""
+        """从单个文件提取代码片段（滑动窗口方式）；文件已删除或不可读时返回空列表"""
+        abs_path = str(file_path)
         try:
-            text = file_path.read_text(encoding="utf-8")
-        except UnicodeDecodeError:
+            fragments = iter_fragments(abs_path, file_path.read_bytes(), window, stride)
+        except (OSError, UnicodeDecodeError):
             return []
 
-        lines = text.splitlines()
-        total_lines = len(lines)
-        fragments = []
-        idx = 0
-
-        while idx < total_lines:
-            segment = lines[idx : idx + window]
-            if segment:
-                snippet = "\n".join(segment)
-                start = idx + 1
-                end = min(idx + window, total_lines)
-
-                # 生成唯一 ID
-                frag_id = hashlib.md5(f"{file_path}:{start}:{end}".encode("utf-8")).hexdigest()
-
-                fragments.append({
-                    "id": frag_id,
-                    "text": snippet,
-                    "abs_path": str(file_path),
-                    "rel_path": str(file_path.relative_to(self.repo_path)),
-                    "language": file_path.suffix.lstrip("."),
-                    "start_line": start,
-                    "end_line": end,
-                })
-            idx += stride
-
-        return fragments
+        rel_path = str(file_path.relative_to(self.repo_path))
+        language = file_path.suffix.lstrip(".")
+        return [
+            {
+                "id": frag_id,
+                "text": snippet,
+                "content_hash": content_hash,
+                "abs_path": abs_path,
+                "rel_path": rel_path,
+                "language": language,
+                "start_line": start,
+                "end_line": end,
+                "start_byte": start_byte,
+                "end_byte": end_byte,
+            }
+            for frag_id, start, end, start_byte, end_byte, snippet, content_hash in fragments
+        ]
+
+    def _extract_all_fragments(self, files: List[Path]) -> List[List[Dict[str, Any]]]:
+        """在常驻线程池中提取多个文件的片段"""
+        return list(self._extract_pool.map(self._extract_fragments, files))
+
+    async def _existing_points(self, abs_path: str) -> Dict[Any, Tuple[Tuple[Any, Any, Any], List[float]]]:
+        """读取文件在集合中已有的点：{id: ((content_hash, start_byte, end_byte), vector)}"""
+        points: Dict[Any, Tuple[Tuple[Any, Any, Any], List[float]]] = {}
+        offset = None
+        while True:
+            records, offset = await self.client.scroll(
+                collection_name=self.collection,
+                scroll_filter=rest.Filter(
+                    must=[rest.FieldCondition(key="abs_path", match=rest.MatchValue(value=abs_path))]
+                ),
+                with_payload=["content_hash", "start_byte", "end_byte"],
+                with_vectors=True,
+                limit=1024,
+                offset=offset,
+            )
+            for record in records:
+                payload = record.payload or {}
+                key = (payload.get("content_hash"), payload.get("start_byte"), payload.get("end_byte"))
+                # scroll 返回带连字符的 UUID，统一为 md5 hex 形式；其他写入方留下的整数 id 原样保留
+                # （不会与片段 id 相同，作为过期点按原 id 删除）
+                point_id = uuid.UUID(record.id).hex if isinstance(record.id, str) else record.id
+                points[point_id] = (key, record.vector)
+            if offset is None:
+                return points
+
+    async def _upsert_fragments(self, fragments: List[Dict[str, Any]]) -> None:
+        """分批 encode 并 upsert：encode 在线程池中执行，同时前几批的 upsert 继续进行
+        （已带 "vector" 的片段直接复用，不再 encode）"""
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPSERTS)
+        pending: List[asyncio.Task] = []
+
+        async def upsert(batch: List[Dict[str, Any]]) -> None:
+            try:
+                await self.client.upsert(
+                    collection_name=self.collection,
+                    points=rest.Batch(
+                        ids=[frag["id"] for frag in batch],
+                        vectors=[frag["vector"] for frag in batch],
+                        payloads=[record_payload(frag) for frag in batch],
+                    ),
+                )
+            finally:
+                semaphore.release()
+
+        try:
+            for i in range(0, len(fragments), UPSERT_BATCH_SIZE):
+                batch = fragments[i : i + UPSERT_BATCH_SIZE]
+                missing = [frag for frag in batch if frag.get("vector") is None]
+                if missing:
+                    # encode 内部按文本长度排序分批，结果仍按原顺序返回
+                    vectors = await loop.run_in_executor(None, self._embed_fragments, missing)
+                    for frag, vector in zip(missing, vectors.tolist()):
+                        frag["vector"] = vector
+                await semaphore.acquire()
+                pending.append(asyncio.create_task(upsert(batch)))
+        finally:
+            results = await asyncio.gather(*pending, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
 
     async def _incremental_update(self) -> Dict[str, Any]:
         """执行增量索引更新"""
+        async with self._update_lock:
+            return await self._run_incremental_update()
+
+    async def _incremental_update_paths(self, paths: Set[str]) -> Dict[str, Any]:
+        """只检查指定路径的增量更新（文件监控模式）；已删除的文件同时删除其片段"""
+        files = []
+        removed = []
+        for path in sorted(paths):
+            file_path = Path(path)
+            if file_path.is_file():
+                files.append(file_path)
+            elif path in self.file_hashes:
+                removed.append(path)
+
+        async with self._update_lock:
+            if removed:
+                await self._delete_file_points(removed)
+            result = await self._run_incremental_update(files)
+
+        # 只删除了文件的批次同样算作一次更新
+        if removed:
+            result["updated"] = True
+            result["deleted_files_count"] = len(removed)
+            result["deleted_files"] = [str(Path(path).relative_to(self.repo_path)) for path in removed]
+        return result
+
+    async def _delete_file_points(self, abs_paths: List[str]) -> None:
+        """删除已不存在的文件在集合中的全部片段"""
+        logger.info(f"🗑️  删除 {len(abs_paths)} 个已移除文件的片段")
+        for abs_path in abs_paths:
+            await self.client.delete(
+                collection_name=self.collection,
+                points_selector=rest.FilterSelector(
+                    filter=rest.Filter(
+                        must=[rest.FieldCondition(key="abs_path", match=rest.MatchValue(value=abs_path))]
+                    )
+                ),
+            )
+            self.file_hashes.pop(abs_path, None)
+        self._save_hash_cache()
+
+    async def _run_incremental_update(self, files: Optional[List[Path]] = None) -> Dict[str, Any]:
         logger.info("🔍 检查代码变化...")
         self.last_check_time = datetime.now()
 
-        modified_files = self._find_modified_files()
+        # 遍历与哈希计算放到线程池中，避免阻塞 MCP 请求
+        loop = asyncio.get_running_loop()
+        modified_files = await loop.run_in_executor(None, self._find_modified_files, files)
 
         if not modified_files:
+            if self._hash_cache_dirty:
+                self._save_hash_cache()
             logger.info("✓ 代码无变化")
             return {"updated": False, "files_count": 0, "fragments_count": 0}
 
         logger.info(f"📝 发现 {len(modified_files)} 个文件有更新")
 
-        # 提取所有变化文件的片段
-        all_fragments = []
-        for file_path in modified_files:
-            fragments = self._extract_fragments(file_path)
-            all_fragments.extend(fragments)
-
-        if not all_fragments:
+        # 提取变化文件的片段，并与集合中已有的点按内容哈希比对：
+        # id、内容与字节偏移都未变的片段跳过；内容在该文件中已存在的片段（包括只是位置移动的）
+        # 复用旧向量重新写入；不再存在的旧 id 删除
+        # 片段提取（读文件、解码、换行扫描）不在事件循环中执行
+        per_file_fragments = await loop.run_in_executor(None, self._extract_all_fragments, modified_files)
+
+        # 各文件已有的点并发读取（远程服务时每个 scroll 都是一次往返）
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_SCROLLS)
+
+        async def existing_points(file_path: Path):
+            async with semaphore:
+                return await self._existing_points(str(file_path))
+
+        existing_by_file = await asyncio.gather(*(existing_points(f) for f in modified_files))
+
+        changed_fragments = []
+        stale_ids: List[Any] = []
+        unchanged_count = 0
+        for fragments, existing in zip(per_file_fragments, existing_by_file):
+            vectors_by_hash = {key[0]: vector for key, vector in existing.values() if key[0]}
+
+            for frag in fragments:
+                cached = existing.get(frag["id"])
+                if cached is not None and cached[0] == (frag["content_hash"], frag["start_byte"], frag["end_byte"]):
+                    unchanged_count += 1
+                    continue
+                frag["vector"] = vectors_by_hash.get(frag["content_hash"])
+                changed_fragments.append(frag)
+
+            new_ids = {frag["id"] for frag in fragments}
+            stale_ids.extend(point_id for point_id in existing if point_id not in new_ids)
+
+        if not changed_fragments and not stale_ids:
+            self._save_hash_cache()
+            logger.info(f"✓ 片段内容无变化 ({unchanged_count} 个片段)")
             return {"updated": False, "files_count": len(modified_files), "fragments_count": 0}
 
-        # 生成向量
-        logger.info(f"🧠 生成向量嵌入 ({len(all_fragments)} 个片段)...")
-        texts = [frag["text"] for frag in all_fragments]
-        embeddings = self.model.encode(texts, batch_size=64, show_progress_bar=False, normalize_embeddings=True)
-
-        # 增量 upsert 到 Qdrant
-        logger.info("☁️  更新向量数据库...")
-        batch_size = 64
-        for i in range(0, len(all_fragments), batch_size):
-            batch = all_fragments[i : i + batch_size]
-            vecs = embeddings[i : i + batch_size].tolist()
-
-            self.client.upsert(
+        if changed_fragments:
+            # 生成向量并增量写入 Qdrant（批量更新时暂停 HNSW 索引构建，完成后恢复原配置）
+            encode_count = sum(1 for frag in changed_fragments if frag["vector"] is None)
+            logger.info(
+                f"🧠 更新向量数据库 ({len(changed_fragments)} 个片段，需生成向量 {encode_count} 个，"
+                f"跳过未变化 {unchanged_count} 个)..."
+            )
+            previous = None
+            if len(modified_files) > BULK_THRESHOLD:
+                logger.info(f"⏸️  批量更新 {len(modified_files)} 个文件，暂停索引构建")
+                previous = await async_pause_indexing(self.client, self.collection)
+            try:
+                await self._upsert_fragments(changed_fragments)
+            finally:
+                if previous is not None:
+                    await async_resume_indexing(self.client, self.collection, previous)
+
+        if stale_ids:
+            logger.info(f"🗑️  删除 {len(stale_ids)} 个过期片段")
+            await self.client.delete(
                 collection_name=self.collection,
-                points=rest.Batch(
-                    ids=[frag["id"] for frag in batch],
-                    vectors=vecs,
-                    payloads=[{
-                        "path": frag["rel_path"],
-                        "abs_path": frag["abs_path"],
-                        "language": frag["language"],
-                        "start_line": frag["start_line"],
-                        "end_line": frag["end_line"],
-                    } for frag in batch],
-                ),
+                points_selector=rest.PointIdsList(points=stale_ids),
             )
 
         # 保存哈希缓存
         self._save_hash_cache()
 
-        logger.info(f"✅ 索引更新完成: {len(all_fragments)} 个片段")
+        logger.info(f"✅ 索引更新完成: {len(changed_fragments)} 个片段")
         return {
             "updated": True,
             "files_count": len(modified_files),
-            "fragments_count": len(all_fragments),
+            "fragments_count": len(changed_fragments),
+            "unchanged_fragments_count": unchanged_count,
+            "deleted_fragments_count": len(stale_ids),
             "updated_files": [str(f.relative_to(self.repo_path)) for f in modified_files]
         }
 
@@ -315,6 +694,41 @@ class QdrantCodebaseService:
             except Exception as e:
                 logger.error(f"❌ 自动更新失败: {e}")
 
+    async def _watch_loop(self, queue: asyncio.Queue) -> None:
+        """文件监控更新循环：收集变化路径，静默 WATCH_DEBOUNCE_SECONDS 秒后只更新这些文件
+        （最迟在第一个事件后 WATCH_MAX_DELAY_SECONDS 秒更新）"""
+        logger.info(f"🚀 启动文件监控更新循环 (防抖: {WATCH_DEBOUNCE_SECONDS:.0f} 秒)")
+
+        # 服务未运行期间的修改没有事件，启动时先做一次全量检查
+        try:
+            await self._incremental_update()
+        except Exception as e:
+            logger.error(f"❌ 自动更新失败: {e}")
+
+        loop = asyncio.get_running_loop()
+        while True:
+            paths = {await queue.get()}
+            deadline = loop.time() + WATCH_MAX_DELAY_SECONDS
+            try:
+                while True:
+                    timeout = min(WATCH_DEBOUNCE_SECONDS, deadline - loop.time())
+                    if timeout <= 0:
+                        break
+                    paths.add(await asyncio.wait_for(queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                result = await self._incremental_update_paths(paths)
+                if result["updated"]:
+                    deleted = result.get("deleted_files_count", 0)
+                    logger.info(
+                        f"🔄 自动更新完成: {result['fragments_count']} 个片段"
+                        + (f"，移除 {deleted} 个文件" if deleted else "")
+                    )
+            except Exception as e:
+                logger.error(f"❌ 自动更新失败: {e}")
+
     # ------------------------------------------------------------------
     # MCP tool registration
     # ------------------------------------------------------------------
@@ -335,8 +749,8 @@ class QdrantCodebaseService:
             - search_code: 语义理解搜索 (用需求描述找实现)
             """
 
-            vector = self._encode(query)
-            hits = self.client.search(
+            vector = await asyncio.get_running_loop().run_in_executor(None, self._encode_cached, query)
+            hits = await self.client.search(
                 collection_name=self.collection,
                 query_vector=vector,
                 limit=top_k,
@@ -344,9 +758,15 @@ class QdrantCodebaseService:
             )
 
             results: List[Dict[str, Any]] = []
+            backfill: List[Tuple[Any, str]] = []
             for hit in hits:
                 payload = hit.payload or {}
-                snippet = self._read_snippet(payload)
+                # payload 中已有片段文本时直接返回，否则回退到读文件
+                snippet = payload.get("text")
+                if snippet is None:
+                    snippet = self._read_snippet(payload)
+                    if self._can_backfill_text(payload, snippet):
+                        backfill.append((hit.id, snippet))
                 results.append(
                     {
                         "score": float(hit.score),
@@ -358,6 +778,9 @@ class QdrantCodebaseService:
                         "snippet": snippet,
                     }
                 )
+
+            if backfill:
+                await self._backfill_payload_text(backfill)
             return results
 
         @self.mcp.tool()
@@ -410,7 +833,7 @@ class QdrantCodebaseService:
             - 诊断搜索问题
             """
 
-            info = self.client.get_collection(self.collection)
+            info = await self.client.get_collection(self.collection)
             description = info.dict()
             return json.loads(json.dumps(description, default=str))
 
@@ -461,15 +884,16 @@ class QdrantCodebaseService:
             - Claude: [调用 index_status] 自动更新已启用，每 30 分钟检查一次，上次检查在 15 分钟前
             """
 
-            info = self.client.get_collection(self.collection)
+            info = await self.client.get_collection(self.collection)
 
             next_check_seconds = None
-            if self.auto_update and self.last_check_time:
+            if self.auto_update and self.update_mode == "poll" and self.last_check_time:
                 elapsed = (datetime.now() - self.last_check_time).total_seconds()
                 next_check_seconds = max(0, self.update_interval - elapsed)
 
             return {
                 "auto_update_enabled": self.auto_update,
+                "update_mode": self.update_mode,
                 "update_interval_minutes": self.update_interval / 60,
                 "last_check_time": self.last_check_time.isoformat() if self.last_check_time else None,
                 "next_check_in_seconds": next_check_seconds,
@@ -488,10 +912,27 @@ class QdrantCodebaseService:
             logger.info(f"🚀 启动 Qdrant Codebase MCP 服务")
             logger.info(f"   服务地址: http://{host}:{port}/mcp")
             logger.info(f"   代码库: {self.repo_path}")
+            logger.info(f"   Qdrant: {self.qdrant_url or self.qdrant_path}")
             logger.info(f"   集合: {self.collection}")
-            logger.info(f"   模型: {self.model_name}")
-
-            if self.auto_update:
+            logger.info(f"   模型: {self.model_name} (backend={self.backend})")
+
+            await self._check_collection()
+            self._update_lock = asyncio.Lock()
+
+            observer = None
+            if self.auto_update and self.update_mode == "watch":
+                logger.info(f"   自动更新: 已启用 (文件监控，防抖 {WATCH_DEBOUNCE_SECONDS:.0f} 秒)")
+                queue: asyncio.Queue = asyncio.Queue()
+                observer = Observer()
+                observer.schedule(
+                    _RepoEventHandler(self.repo_path, self.qdrant_path, asyncio.get_running_loop(), queue),
+                    str(self.repo_path),
+                    recursive=True,
+                )
+                observer.start()
+                # 启动后台更新任务
+                self.update_task = asyncio.create_task(self._watch_loop(queue))
+            elif self.auto_update:
                 logger.info(f"   自动更新: 已启用 (间隔: {self.update_interval / 60:.0f} 分钟)")
                 # 启动后台更新任务
                 self.update_task = asyncio.create_task(self._auto_update_loop())
@@ -508,7 +949,15 @@ class QdrantCodebaseService:
             logger.info("=" * 60)
 
             # 使用 SSE 传输模式
-            await self.mcp.run(transport="sse", host=host, port=port)
+            try:
+                await self.mcp.run(transport="sse", host=host, port=port)
+            finally:
+                if observer is not None:
+                    observer.stop()
+                    observer.join()
+                await self.client.close()
+                self._extract_pool.shutdown(wait=True)
+                self.embedding_cache.close()
 
         asyncio.run(run_service())
 
@@ -522,20 +971,44 @@ def build_parser() -> argparse.ArgumentParser:
   # 启动服务（无自动更新）
   python qdrant_codebase_mcp.py --repo /path/to/repo --collection codebase
 
-  # 启动服务并启用自动更新（每 30 分钟）
+  # 启动服务并启用自动更新（监控文件变化）
   python qdrant_codebase_mcp.py --repo /path/to/repo --collection codebase --auto-update
 
-  # 自定义更新间隔（每 10 分钟）
-  python qdrant_codebase_mcp.py --repo /path/to/repo --collection codebase --auto-update --update-interval 10
+  # 定时扫描模式（NFS/容器等文件事件不可靠的环境），每 10 分钟
+  python qdrant_codebase_mcp.py --repo /path/to/repo --collection codebase --auto-update \
+    --update-mode poll --update-interval 10
+
+  # 连接远程 Qdrant 服务（gRPC）
+  python qdrant_codebase_mcp.py --repo /path/to/repo --collection codebase --url http://localhost:6333
+
+  # 使用 ONNX Runtime + INT8 量化模型（AVX512-VNNI CPU）
+  python qdrant_codebase_mcp.py --repo /path/to/repo --collection codebase \
+    --backend onnx --model-file onnx/model_qint8_avx512_vnni.onnx
+
+依赖:
+  pip install fastmcp qdrant-client sentence-transformers tqdm
+  pip install watchdog  # 可选，--update-mode watch（默认）
+  pip install blake3  # 可选，加速文件哈希
+  pip install orjson  # 可选，加速哈希缓存读写
+  pip install "sentence-transformers[onnx]"  # 可选，--backend onnx
         """
     )
     parser.add_argument("--repo", required=True, help="Path to repository root used during indexing")
     parser.add_argument("--qdrant-path", default="./qdrant_storage", help="Directory where Qdrant local data lives")
+    parser.add_argument("--url", default=None,
+                        help="Qdrant server URL (uses gRPC); --qdrant-path then only holds the local caches")
     parser.add_argument("--collection", default="codebase", help="Collection name")
     parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2", help="Embedding model (must match indexer)")
     parser.add_argument("--port", type=int, default=8890, help="HTTP port for MCP server")
     parser.add_argument("--auto-update", action="store_true", help="Enable automatic index updates")
-    parser.add_argument("--update-interval", type=int, default=30, help="Auto-update interval in minutes (default: 30)")
+    parser.add_argument("--update-mode", choices=["watch", "poll"], default="watch",
+                        help="Auto-update trigger: file system events (watch) or periodic scan (poll)")
+    parser.add_argument("--update-interval", type=int, default=None,
+                        help="Auto-update interval in minutes for --update-mode poll (default: 30)")
+    parser.add_argument("--backend", choices=["torch", "onnx", "openvino"], default="torch",
+                        help="SentenceTransformer inference backend")
+    parser.add_argument("--model-file", default=None,
+                        help="Model file for onnx/openvino backend, e.g. onnx/model_qint8_avx512_vnni.onnx")
     return parser
 
 
@@ -547,13 +1020,21 @@ def main() -> None:
     if not repo_path.exists():
         raise SystemExit(f"Repository not found: {repo_path}")
 
+    # 文件监控模式不按间隔扫描；未安装 watchdog 时会回退为定时扫描，此时间隔仍然生效
+    if args.update_interval is not None and args.update_mode != "poll" and HAS_WATCHDOG:
+        logger.warning("⚠️  --update-interval 只在 --update-mode poll 下生效，文件监控模式将忽略该参数")
+
     service = QdrantCodebaseService(
         repo_path=repo_path,
         qdrant_path=Path(args.qdrant_path),
         collection=args.collection,
         model_name=args.model,
         auto_update=args.auto_update,
-        update_interval_minutes=args.update_interval,
+        update_interval_minutes=args.update_interval if args.update_interval is not None else 30,
+        update_mode=args.update_mode,
+        backend=args.backend,
+        model_file=args.model_file,
+        qdrant_url=args.url,
     )
     service.serve(args.port)
 
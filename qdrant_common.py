@@ -0,0 +1,298 @@
+"""Qdrant 代码索引脚本的公共部分
+qdrant_auto_updater.py / qdrant_codebase_mcp.py / qdrant_incremental_update.py 共用。
+
+片段切分、片段 id 与内容哈希决定了不同写入方能否识别同一个片段
+（跳过未变化片段、共用向量缓存、校验搜索结果），因此只在这里实现一份。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from qdrant_client.http import models as rest
+from sentence_transformers import SentenceTransformer
+
+try:
+    from blake3 import blake3
+    HAS_BLAKE3 = True
+except ImportError:
+    HAS_BLAKE3 = False
+
+logger = logging.getLogger(__name__)
+
+# 单次更新超过该文件数时视为批量更新，写入期间暂停 HNSW 索引构建
+# （少量文件时暂停/恢复本身的开销与优化器抖动得不偿失）
+BULK_THRESHOLD = 50
+
+# 扫描与文件监控都跳过的目录（任意层级；构建产物与依赖，隐藏目录/文件另外统一跳过）
+IGNORED_DIRS = frozenset({"__pycache__", "node_modules", "build", "dist", "target"})
+
+# 文件哈希的分块读取大小（1 MiB）
+HASH_CHUNK_SIZE = 1 << 20
+
+# 不超过该长度的片段文本直接写入 payload，搜索时无需再读文件
+PAYLOAD_TEXT_MAX_CHARS = 8192
+
+# str.splitlines() 除 \n 外还会切分的字符；出现时按行切分，保证行号与索引器一致
+_IRREGULAR_LINE_BREAKS = re.compile(rb"[\x0b\x0c\x1c-\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]|\r(?!\n)")
+
+# 片段: (id, start_line, end_line, start_byte, end_byte, 文本, 内容哈希)
+Fragment = Tuple[str, int, int, Optional[int], Optional[int], str, str]
+
+
+def window_bounds(line_starts: np.ndarray, content_end: int, window: int, stride: int):
+    """一次性计算所有窗口的 (start_line, end_line, start_byte, end_byte)，返回四个 int64 数组"""
+    total_lines = len(line_starts)
+    starts = np.arange(0, total_lines, stride, dtype=np.int64)
+    ends = np.minimum(starts + window, total_lines)
+    # 窗口结束于下一行行首前的换行符；最后一个窗口结束于内容末尾（不含末尾换行）
+    next_starts = np.append(line_starts, content_end + 1)
+    return starts + 1, ends, line_starts[starts], next_starts[ends] - 1
+
+
+def iter_windows(data: bytes, window: int, stride: int):
+    """按滑动窗口切分文件内容，产出 (start_line, end_line, start_byte, end_byte, snippet)，
+    行号与 str.splitlines() 一致；按行切分的回退路径没有字节偏移（为 None）"""
+    if _IRREGULAR_LINE_BREAKS.search(data):
+        lines = data.decode("utf-8").splitlines()
+        for idx in range(0, len(lines), stride):
+            end = min(idx + window, len(lines))
+            yield idx + 1, end, None, None, "\n".join(lines[idx:end])
+        return
+
+    # 一次 NumPy 扫描得到所有行首偏移，片段直接切原始字节，无需逐行 split/join
+    line_starts = np.concatenate(([0], np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 0x0A) + 1))
+    if line_starts[-1] == len(data):
+        line_starts = line_starts[:-1]  # 末尾换行不构成新行
+    content_end = len(data) - 1 if data.endswith(b"\n") else len(data)
+    bounds = window_bounds(line_starts, content_end, window, stride)
+    crlf = b"\r\n" in data
+    view = memoryview(data)
+
+    for start, end, start_byte, end_byte in zip(*(column.tolist() for column in bounds)):
+        if crlf:
+            segment = data[start_byte:end_byte].replace(b"\r\n", b"\n")
+            if segment.endswith(b"\r"):
+                segment = segment[:-1]
+            yield start, end, start_byte, end_byte, segment.decode("utf-8")
+        else:
+            yield start, end, start_byte, end_byte, str(view[start_byte:end_byte], "utf-8")
+
+
+def hash_text(text: str) -> str:
+    """片段文本哈希（非加密用途）；结果会持久化并在各写入方之间比对，固定使用标准库 BLAKE2b"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def iter_fragments(abs_path: str, data: bytes, window: int = 80, stride: int = 60) -> List[Fragment]:
+    """切分单个文件的全部片段；文件不是 UTF-8 时抛出 UnicodeDecodeError"""
+    windows = list(iter_windows(data, window, stride))
+
+    # id = md5(f"{file_path}:{start}:{end}")：路径前缀只哈希一次，每个片段复制其中间状态
+    id_prefix = hashlib.md5(f"{abs_path}:".encode("utf-8"))
+    fragments: List[Fragment] = []
+    for start, end, start_byte, end_byte, snippet in windows:
+        frag_hasher = id_prefix.copy()
+        frag_hasher.update(f"{start}:{end}".encode("ascii"))
+        fragments.append(
+            (frag_hasher.hexdigest(), start, end, start_byte, end_byte, snippet, hash_text(snippet))
+        )
+    return fragments
+
+
+def fragment_payload(
+    rel_path: str,
+    abs_path: str,
+    language: str,
+    start_line: int,
+    end_line: int,
+    start_byte: Optional[int],
+    end_byte: Optional[int],
+    content_hash: str,
+    text: str,
+) -> Dict[str, Any]:
+    """片段在 Qdrant 中的 payload；超过 PAYLOAD_TEXT_MAX_CHARS 的文本不写入（搜索时从文件读取）"""
+    return {
+        "path": rel_path,
+        "abs_path": abs_path,
+        "language": language,
+        "start_line": start_line,
+        "end_line": end_line,
+        "start_byte": start_byte,
+        "end_byte": end_byte,
+        "content_hash": content_hash,
+        "text": text if len(text) <= PAYLOAD_TEXT_MAX_CHARS else None,
+    }
+
+
+def record_payload(frag: Dict[str, Any]) -> Dict[str, Any]:
+    """fragment_payload 的字典版本，用于 {"rel_path", "abs_path", ...} 形式的片段记录"""
+    return fragment_payload(
+        frag["rel_path"],
+        frag["abs_path"],
+        frag["language"],
+        frag["start_line"],
+        frag["end_line"],
+        frag["start_byte"],
+        frag["end_byte"],
+        frag["content_hash"],
+        frag["text"],
+    )
+
+
+def compute_file_hash(file_path: Path) -> str:
+    """计算文件哈希（优先 BLAKE3，未安装时回退 MD5），按块读取避免整文件载入内存；失败时返回空串"""
+    try:
+        if HAS_BLAKE3:
+            hasher = blake3()
+            hasher.update_mmap(file_path)
+            return hasher.hexdigest()
+        hasher = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+    except Exception:
+        return ""
+
+
+class EmbeddingCache:
+    """片段向量持久缓存：(模型, 内容哈希) → float16 向量，存储在 SQLite 中，可被多个进程共享"""
+
+    def __init__(self, path: Path, model_name: str) -> None:
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT, content_hash TEXT, vector BLOB, PRIMARY KEY (model, content_hash))"
+        )
+        self.db.commit()
+
+    def get_many(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """批量查询，返回命中的 {content_hash: float32 向量}"""
+        found: Dict[str, np.ndarray] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            # SQLite 单条语句的参数个数有限，分块查询
+            for i in range(0, len(unique), 500):
+                chunk = unique[i : i + 500]
+                rows = self.db.execute(
+                    "SELECT content_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND content_hash IN ({', '.join('?' * len(chunk))})",
+                    [self.model_name, *chunk],
+                )
+                for content_hash, blob in rows:
+                    found[content_hash] = np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+        return found
+
+    def put_many(self, hashes: List[str], vectors: np.ndarray) -> None:
+        """批量写入新生成的向量（以 float16 存储）"""
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, content_hash, vector) VALUES (?, ?, ?)",
+                [
+                    (self.model_name, content_hash, vector.astype(np.float16).tobytes())
+                    for content_hash, vector in zip(hashes, vectors)
+                ],
+            )
+            self.db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self.db.close()
+
+
+def load_embedding_model(
+    model_name: str,
+    backend: str = "torch",
+    model_file: Optional[str] = None,
+    num_threads: Optional[int] = None,
+) -> SentenceTransformer:
+    """加载嵌入模型；onnx/openvino 后端可通过 model_file 指定量化后的模型文件"""
+    # 默认安装的 torch 可能只用到少量 intra-op 线程
+    torch.set_num_threads(num_threads or os.cpu_count() or 1)
+    try:
+        torch.set_num_interop_threads(2)
+    except RuntimeError:
+        # 已有并行任务运行过时不允许再修改
+        pass
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if backend == "torch":
+        model = SentenceTransformer(model_name, device=device)
+        if device == "cuda":
+            model.half()
+    else:
+        model_kwargs = {"file_name": model_file} if model_file else None
+        model = SentenceTransformer(model_name, device=device, backend=backend, model_kwargs=model_kwargs)
+    model.eval()
+    return model
+
+
+def pause_indexing(client, collection: str) -> Optional[int]:
+    """暂停 HNSW 索引构建（indexing_threshold=0），返回需要恢复的原值；失败时返回 None。
+    读到 0 说明另一个写入方正在批量写入，由它负责恢复，这里既不修改也不恢复"""
+    try:
+        info = client.get_collection(collection)
+        previous = info.config.optimizer_config.indexing_threshold
+        if not previous:
+            return None
+        client.update_collection(
+            collection_name=collection,
+            optimizer_config=rest.OptimizersConfigDiff(indexing_threshold=0),
+        )
+        return previous
+    except Exception as e:
+        logger.warning(f"无法暂停索引构建: {e}")
+        return None
+
+
+def resume_indexing(client, collection: str, threshold: int) -> None:
+    """恢复 pause_indexing 之前的 indexing_threshold"""
+    try:
+        client.update_collection(
+            collection_name=collection,
+            optimizer_config=rest.OptimizersConfigDiff(indexing_threshold=threshold),
+        )
+    except Exception as e:
+        logger.warning(f"无法恢复 indexing_threshold={threshold}: {e}")
+
+
+async def async_pause_indexing(client, collection: str) -> Optional[int]:
+    """pause_indexing 的 AsyncQdrantClient 版本"""
+    try:
+        info = await client.get_collection(collection)
+        previous = info.config.optimizer_config.indexing_threshold
+        if not previous:
+            return None
+        await client.update_collection(
+            collection_name=collection,
+            optimizer_config=rest.OptimizersConfigDiff(indexing_threshold=0),
+        )
+        return previous
+    except Exception as e:
+        logger.warning(f"无法暂停索引构建: {e}")
+        return None
+
+
+async def async_resume_indexing(client, collection: str, threshold: int) -> None:
+    """resume_indexing 的 AsyncQdrantClient 版本"""
+    try:
+        await client.update_collection(
+            collection_name=collection,
+            optimizer_config=rest.OptimizersConfigDiff(indexing_threshold=threshold),
+        )
+    except Exception as e:
+        logger.warning(f"无法恢复 indexing_threshold={threshold}: {e}")
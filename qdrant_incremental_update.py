@@ -33,16 +33,26 @@
 from __future__ import annotations
 
 import argparse
-import hashlib
 import json
 import logging
+import os
 import sys
 from pathlib import Path
 from typing import List
 
+import numpy as np
+import torch
 from qdrant_client import QdrantClient
-from qdrant_client.http import models as rest
-from sentence_transformers import SentenceTransformer
+
+from qdrant_common import (
+    BULK_THRESHOLD,
+    EmbeddingCache,
+    iter_fragments,
+    load_embedding_model,
+    pause_indexing,
+    record_payload,
+    resume_indexing,
+)
 
 # 日志配置
 logging.basicConfig(
@@ -57,6 +67,13 @@ SUPPORTED_EXTENSIONS = {
     ".c", ".cc", ".cpp", ".h", ".hpp", ".xml", ".json"
 }
 
+# upload_collection 的批大小与并行进程数（本地模式下 parallel 不生效，按批顺序写入）
+UPLOAD_BATCH_SIZE = 256
+UPLOAD_PARALLEL = max(2, (os.cpu_count() or 1) // 2)
+# 并行上传的工作进程会重新导入本脚本（torch、sentence_transformers），启动需要数秒，
+# 只有批次数超过该值时才并行；一次普通提交按单进程顺序上传
+UPLOAD_PARALLEL_MIN_BATCHES = 16
+
 
 class QuietMode:
     """静默模式上下文管理器"""
@@ -80,23 +97,32 @@ class QdrantIncrementalUpdater:
         collection: str,
         model_name: str,
         quiet: bool = False,
+        backend: str = "torch",
+        model_file: str | None = None,
+        qdrant_url: str | None = None,
     ):
         self.repo_path = repo_path.resolve()
         self.qdrant_path = qdrant_path.resolve()
         self.collection = collection
         self.quiet = quiet
+        self.backend = backend
+        self.model_file = model_file
 
         # Qdrant 客户端
         try:
-            self.client = QdrantClient(path=str(qdrant_path))
+            if qdrant_url:
+                # 远程服务走 gRPC：向量以二进制 float 数组传输，无需 JSON 序列化
+                self.client = QdrantClient(url=qdrant_url, prefer_grpc=True)
+            else:
+                self.client = QdrantClient(path=str(qdrant_path))
         except Exception as e:
             self._log_error(f"无法连接 Qdrant: {e}")
             sys.exit(1)
 
         # 嵌入模型
         try:
-            self._log_info(f"加载模型: {model_name}")
-            self.model = SentenceTransformer(model_name)
+            self._log_info(f"加载模型: {model_name} (backend={backend})")
+            self.model = load_embedding_model(model_name, backend, model_file, num_threads=os.cpu_count() or 1)
         except Exception as e:
             self._log_error(f"无法加载模型: {e}")
             sys.exit(1)
@@ -104,6 +130,16 @@ class QdrantIncrementalUpdater:
         # 检查集合
         self._check_collection()
 
+        # 片段向量缓存（与 MCP 服务共用同一文件；--url 模式下缓存目录可能还不存在）
+        try:
+            self.qdrant_path.mkdir(parents=True, exist_ok=True)
+            self.embedding_cache = EmbeddingCache(
+                self.qdrant_path / f"{collection}_embedding_cache.sqlite3", model_name
+            )
+        except Exception as e:
+            self._log_error(f"无法打开向量缓存: {e}")
+            sys.exit(1)
+
     def _log_info(self, msg: str) -> None:
         if not self.quiet:
             logger.info(msg)
@@ -123,43 +159,36 @@ class QdrantIncrementalUpdater:
 
     def _extract_fragments(self, file_path: Path, window: int = 80, stride: int = 60):
         """提取代码片段"""
+        abs_path = str(file_path)
         try:
-            text = file_path.read_text(encoding="utf-8")
+            fragments = iter_fragments(abs_path, file_path.read_bytes(), window, stride)
         except Exception:
             return []
 
-        lines = text.splitlines()
-        total_lines = len(lines)
-        fragments = []
-        idx = 0
-
-        while idx < total_lines:
-            segment = lines[idx : idx + window]
-            if segment:
-                snippet = "\n".join(segment)
-                start = idx + 1
-                end = min(idx + window, total_lines)
-
-                frag_id = hashlib.md5(f"{file_path}:{start}:{end}".encode("utf-8")).hexdigest()
-
-                fragments.append({
-                    "id": frag_id,
-                    "text": snippet,
-                    "abs_path": str(file_path),
-                    "rel_path": str(file_path.relative_to(self.repo_path)),
-                    "language": file_path.suffix.lstrip("."),
-                    "start_line": start,
-                    "end_line": end,
-                })
-            idx += stride
-
-        return fragments
+        rel_path = str(file_path.relative_to(self.repo_path))
+        language = file_path.suffix.lstrip(".")
+        return [
+            {
+                "id": frag_id,
+                "text": snippet,
+                "content_hash": content_hash,
+                "abs_path": abs_path,
+                "rel_path": rel_path,
+                "language": language,
+                "start_line": start,
+                "end_line": end,
+                "start_byte": start_byte,
+                "end_byte": end_byte,
+            }
+            for frag_id, start, end, start_byte, end_byte, snippet, content_hash in fragments
+        ]
 
     def update_files(self, file_paths: List[str]) -> dict:
         """更新指定的文件列表"""
         total_fragments = 0
         processed_files = 0
         skipped_files = 0
+        pending = []  # (file_str, fragments)
 
         for file_str in file_paths:
             if not file_str.strip():
@@ -188,39 +217,75 @@ class QdrantIncrementalUpdater:
                     skipped_files += 1
                     continue
 
-                # 生成向量
-                texts = [frag["text"] for frag in fragments]
-                embeddings = self.model.encode(
-                    texts,
-                    batch_size=64,
-                    show_progress_bar=False,
-                    normalize_embeddings=True
-                )
-
-                # Upsert 到 Qdrant
-                self.client.upsert(
-                    collection_name=self.collection,
-                    points=rest.Batch(
-                        ids=[frag["id"] for frag in fragments],
-                        vectors=embeddings.tolist(),
-                        payloads=[{
-                            "path": frag["rel_path"],
-                            "abs_path": frag["abs_path"],
-                            "language": frag["language"],
-                            "start_line": frag["start_line"],
-                            "end_line": frag["end_line"],
-                        } for frag in fragments],
-                    ),
-                )
-
-                total_fragments += len(fragments)
-                processed_files += 1
-                self._log_info(f"  ✓ {len(fragments)} 个片段")
+                pending.append((file_str, fragments))
 
             except Exception as e:
                 self._log_error(f"  ✗ 失败: {e}")
                 skipped_files += 1
 
+        if not pending:
+            return {
+                "processed_files": processed_files,
+                "skipped_files": skipped_files,
+                "total_fragments": total_fragments,
+            }
+
+        # 所有文件的片段一次性生成向量：encode 内部按文本长度排序后分批，
+        # 跨文件的片段也能凑成长度相近的批次，减少 padding 计算
+        # 内容哈希命中持久缓存的片段直接复用向量，只对未命中的片段调用模型
+        all_fragments = [frag for _, fragments in pending for frag in fragments]
+        hashes = [frag["content_hash"] for frag in all_fragments]
+        try:
+            cached = self.embedding_cache.get_many(hashes)
+            misses = [i for i, content_hash in enumerate(hashes) if content_hash not in cached]
+            if misses:
+                with torch.inference_mode():
+                    encoded = self.model.encode(
+                        [all_fragments[i]["text"] for i in misses],
+                        batch_size=64,
+                        show_progress_bar=False,
+                        normalize_embeddings=True
+                    )
+                miss_hashes = [hashes[i] for i in misses]
+                self.embedding_cache.put_many(miss_hashes, encoded)
+                cached.update(zip(miss_hashes, encoded))
+            self._log_info(f"  向量缓存命中 {len(all_fragments) - len(misses)}/{len(all_fragments)}")
+            embeddings = np.stack([cached[content_hash] for content_hash in hashes])
+        except Exception as e:
+            self._log_error(f"  ✗ 向量生成失败: {e}")
+            return {
+                "processed_files": processed_files,
+                "skipped_files": skipped_files + len(pending),
+                "total_fragments": total_fragments,
+            }
+
+        # 写入 Qdrant（批量更新时暂停 HNSW 索引构建，完成后恢复原配置）
+        previous = None
+        if len(pending) > BULK_THRESHOLD:
+            previous = pause_indexing(self.client, self.collection)
+        parallel = UPLOAD_PARALLEL if len(all_fragments) > UPLOAD_PARALLEL_MIN_BATCHES * UPLOAD_BATCH_SIZE else 1
+        try:
+            self.client.upload_collection(
+                collection_name=self.collection,
+                vectors=embeddings,
+                payload=[record_payload(frag) for frag in all_fragments],
+                ids=[frag["id"] for frag in all_fragments],
+                batch_size=UPLOAD_BATCH_SIZE,
+                parallel=parallel,
+                wait=False,
+            )
+        except Exception as e:
+            self._log_error(f"  ✗ 写入失败: {e}")
+            skipped_files += len(pending)
+        else:
+            for file_str, fragments in pending:
+                self._log_info(f"  ✓ {file_str}: {len(fragments)} 个片段")
+            processed_files += len(pending)
+            total_fragments += len(all_fragments)
+        finally:
+            if previous is not None:
+                resume_indexing(self.client, self.collection, previous)
+
         return {
             "processed_files": processed_files,
             "skipped_files": skipped_files,
@@ -244,6 +309,13 @@ def build_parser() -> argparse.ArgumentParser:
   # 静默模式（适合 Git Hook）
   python qdrant_incremental_update.py --repo . --files "src/main.py" --quiet
 
+  # 连接远程 Qdrant 服务（gRPC）
+  python qdrant_incremental_update.py --repo . --files "src/main.py" --url http://localhost:6333
+
+  # 使用 ONNX Runtime + INT8 量化模型（AVX512-VNNI CPU）
+  python qdrant_incremental_update.py --repo . --files "src/main.py" \
+    --backend onnx --model-file onnx/model_qint8_avx512_vnni.onnx
+
 Git Hook 集成:
   在 .git/hooks/post-commit 中添加:
 
@@ -255,14 +327,24 @@ Git Hook 集成:
             --files "$CHANGED_FILES" \\
             --quiet || true
     fi
+
+依赖:
+  pip install qdrant-client sentence-transformers
+  pip install "sentence-transformers[onnx]"  # 可选，--backend onnx
         """
     )
     parser.add_argument("--repo", required=True, help="Repository root path")
     parser.add_argument("--qdrant-path", default="./qdrant_storage", help="Qdrant storage directory")
+    parser.add_argument("--url", default=None,
+                        help="Qdrant server URL (uses gRPC); --qdrant-path then only holds the local caches")
     parser.add_argument("--collection", default="codebase", help="Collection name")
     parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2", help="Embedding model")
     parser.add_argument("--files", required=True, help="Files to update (newline-separated)")
     parser.add_argument("--quiet", "-q", action="store_true", help="Quiet mode (minimal output)")
+    parser.add_argument("--backend", choices=["torch", "onnx", "openvino"], default="torch",
+                        help="SentenceTransformer inference backend")
+    parser.add_argument("--model-file", default=None,
+                        help="Model file for onnx/openvino backend, e.g. onnx/model_qint8_avx512_vnni.onnx")
     return parser
 
 
@@ -293,6 +375,9 @@ def main() -> None:
             collection=args.collection,
             model_name=args.model,
             quiet=args.quiet,
+            backend=args.backend,
+            model_file=args.model_file,
+            qdrant_url=args.url,
         )
 
         logger.info(f"更新 {len(file_list)} 个文件...")